@@ -31,10 +31,12 @@ class Exporter:
             node.childNodes.remove(child_node)
 
     def write_xml(self, robot: Robot, filename: str) -> str:
-        with open(filename, "w") as file:
-            self.build(robot)
-            dom = xml.dom.minidom.parseString(self.xml)
-            self.remove_empty_text_nodes(dom)
-            xml_output = dom.toprettyxml(indent="  ")
+        self.build(robot)
+        dom = xml.dom.minidom.parseString(self.xml)
+        self.remove_empty_text_nodes(dom)
+        xml_output = dom.toprettyxml(indent="  ")
+
+        # The whole document is written at once, through a large buffer
+        with open(filename, "w", buffering=1 << 20, encoding="utf-8") as file:
             file.write(xml_output)
             print(success(f"* Writing {os.path.basename(filename)}"))
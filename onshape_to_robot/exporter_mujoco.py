@@ -1,3 +1,4 @@
+import io
 import numpy as np
 import os
 from .message import success, warning, info
@@ -5,19 +6,97 @@ from .robot import Robot, Link, Part, Joint, Closure
 from .config import Config
 from .geometry import Box, Cylinder, Sphere, Mesh, Shape
 from .exporter import Exporter
-from .exporter_utils import xml_escape, rotation_matrix_to_rpy
-from transforms3d.quaternions import mat2quat
+from .exporter_utils import (
+    xml_escape,
+    rotation_matrix_to_rpy,
+    rotation_matrix_to_quaternion,
+    inverse_transform,
+)
+
+IDENTITY = np.eye(4).tolist()
+IDENTITY_POS_QUAT = (0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0)
+POS_QUAT_FORMAT = 'pos="%g %g %g" quat="%g %g %g %g"'
+JOINT_ATTRIBUTES = frozenset(
+    ("class", "frictionloss", "armature", "damping", "stiffness")
+)
+INERTIAL_FORMAT = (
+    '<inertial pos="%g %g %g" mass="%g" fullinertia="%g %g %g %g %g %g" />'
+)
+
+
+def box_size(box: Box) -> tuple[float, float, float]:
+    """
+    Box size attribute (MuJoCo expects half-sizes)
+    """
+    x, y, z = box.size.tolist()
+    return x / 2, y / 2, z / 2
+
+
+# Pure shapes size attribute values, by shape class
+SHAPE_SIZES = {
+    Box: box_size,
+    Cylinder: lambda shape: (shape.radius, shape.length / 2),
+    Sphere: lambda shape: (shape.radius,),
+}
+
+# Pure shapes MuJoCo type and number of size values, by shape class
+SHAPE_TYPES = {Box: ("box", 3), Cylinder: ("cylinder", 2), Sphere: ("sphere", 1)}
+
+# Pure shape <geom> templates by (shape class, visual), filled with the
+# position, quaternion, size and (for visual geoms) material
+SHAPE_FORMATS = {
+    (shape_class, visual): (
+        f'<geom class="{"visual" if visual else "collision"}" {POS_QUAT_FORMAT} '
+        f'type="{geom_type}" size="{" ".join(["%g"] * size_count)}"'
+        + (' material="%s" />' if visual else " />")
+    )
+    for shape_class, (geom_type, size_count) in SHAPE_TYPES.items()
+    for visual in (True, False)
+}
+MESH_FORMAT = (
+    f'<geom type="mesh" class="%s" {POS_QUAT_FORMAT} mesh="%s" material="%s" />'
+)
 
 
 class ExporterMuJoCo(Exporter):
+    # Default classes, only depending on the robot name
+    DEFAULTS: str = (
+        "<default>"
+        '<default class="{default_class}">'
+        '<joint frictionloss="0.1" armature="0.005"/>'
+        '<position kp="50" dampratio="1" />'
+        '<default class="visual">'
+        '<geom type="mesh" contype="0" conaffinity="0" group="2"/>'
+        "</default>"
+        '<default class="collision">'
+        '<geom group="3"/>'
+        "</default>"
+        "</default>"
+        "</default>"
+    )
+
     def __init__(self, config: Config | None = None):
         super().__init__()
         self.config: Config = config
 
         self.no_dynamics: bool = False
         self.additional_xml: str = ""
-        self.meshes: list = []
+        # Mesh files, used as an ordered set
+        self.meshes: dict[str, None] = {}
         self.materials: dict = {}
+        self.escaped: dict[str, str] = {}
+        self.mesh_names: dict[str, tuple[str, str, str]] = {}
+        self._buf: io.StringIO = io.StringIO()
+
+        # Relative transformations, computed by compute_transforms()
+        self.T_world_link: dict[Link, np.ndarray] = {}
+        self.T_parent_link: dict[Link, np.ndarray] = {}
+        self.T_link_part: dict[Part, np.ndarray] = {}
+        self.T_link_shape: dict[Shape, np.ndarray] = {}
+        self.T_link_frame: dict[tuple[Link, str], np.ndarray] = {}
+
+        # Joints having a given link as parent, computed in build()
+        self.link_joints: dict[Link, list[Joint]] = {}
 
         if config is not None:
             self.no_dynamics = config.no_dynamics
@@ -34,46 +113,42 @@ class ExporterMuJoCo(Exporter):
             self.additional_xml += file.read()
 
     def append(self, line: str):
-        self.xml += line
+        self._buf.write(line)
 
     def build(self, robot: Robot):
-        self.xml = ""
-        self.append('<?xml version="1.0" ?>')
-        self.append("<!-- Generated using onshape-to-robot -->")
+        self._buf = io.StringIO()
+        version = ""
         if self.config:
-            self.append(f"<!-- Onshape {self.config.printable_version()} -->")
-        self.append(f'<mujoco model="{robot.name}">')
+            version = f"<!-- Onshape {self.config.printable_version()} -->"
         self.append(
+            '<?xml version="1.0" ?>'
+            "<!-- Generated using onshape-to-robot -->"
+            f"{version}"
+            f'<mujoco model="{robot.name}">'
             f'<compiler angle="radian" meshdir="{self.config.assets_directory}" autolimits="true" />'
         )
 
         # Boilerplate
         self.default_class = robot.name
-        self.append("<default>")
-        self.append(f'<default class="{self.default_class}">')
-        self.append('<joint frictionloss="0.1" armature="0.005"/>')
-        self.append('<position kp="50" dampratio="1" />')
-        self.append('<default class="visual">')
-        self.append('<geom type="mesh" contype="0" conaffinity="0" group="2"/>')
-        self.append("</default>")
-        self.append('<default class="collision">')
-        self.append('<geom group="3"/>')
-        self.append("</default>")
-        self.append("</default>")
-        self.append("</default>")
+        self.append(self.DEFAULTS.format(default_class=self.default_class))
 
         if self.additional_xml:
             self.append(self.additional_xml)
 
         # Adding robot links
+        self.compute_transforms(robot)
+        self.link_joints = {}
+        for joint in robot.joints:
+            self.link_joints.setdefault(joint.parent, []).append(joint)
+
         self.append("<worldbody>")
         for base_link in robot.base_links:
-            self.add_link(robot, base_link)
+            self.add_link(base_link)
         self.append("</worldbody>")
 
         # Asset (mesh & materials)
         self.append("<asset>")
-        for mesh_file in set(self.meshes):
+        for mesh_file in self.meshes:
             self.append(f'<mesh file="{mesh_file}" />')
         for material_name, color in self.materials.items():
             color_str = "%g %g %g 1" % tuple(color)
@@ -88,8 +163,78 @@ class ExporterMuJoCo(Exporter):
 
         self.append("</mujoco>")
 
+        self.xml = self._buf.getvalue()
         return self.xml
 
+    def compute_transforms(self, robot: Robot):
+        """
+        Computes all the relative transformations needed to place bodies,
+        geometries and sites, using batched numpy operations rather than one
+        matrix product per element
+        """
+
+        def stack(matrices: list[np.ndarray]) -> np.ndarray:
+            return np.array(matrices, dtype=float).reshape(-1, 4, 4)
+
+        # Base links are expressed in the world, other links are located
+        # at their parent joint
+        T_world_link = {link: np.eye(4) for link in robot.base_links}
+        parent_link = {}
+        for joint in robot.joints:
+            T_world_link[joint.child] = joint.T_world_joint
+            parent_link[joint.child] = joint.parent
+
+        links = list(T_world_link)
+        link_index = {link: index for index, link in enumerate(links)}
+        Ts_world_link = stack([T_world_link[link] for link in links])
+        Ts_link_world = inverse_transform(Ts_world_link)
+
+        # Bodies are placed relatively to their parent body
+        parent_index = [link_index.get(parent_link.get(link)) for link in links]
+        Ts_parent_link = Ts_world_link.copy()
+        children = [
+            index for index, parent in enumerate(parent_index) if parent is not None
+        ]
+        Ts_parent_link[children] = (
+            Ts_link_world[[parent_index[index] for index in children]]
+            @ Ts_world_link[children]
+        )
+
+        # Parts, shapes and frames are placed relatively to their link
+        parts, part_link = [], []
+        frames, frame_link, Ts_world_frame = [], [], []
+        for link in links:
+            for part in link.parts:
+                parts.append(part)
+                part_link.append(link_index[link])
+            for frame, T_world_frame in link.frames.items():
+                frames.append((link, frame))
+                frame_link.append(link_index[link])
+                Ts_world_frame.append(T_world_frame)
+
+        Ts_link_part = Ts_link_world[np.array(part_link, dtype=int)] @ stack(
+            [part.T_world_part for part in parts]
+        )
+        Ts_link_frame = Ts_link_world[np.array(frame_link, dtype=int)] @ stack(
+            Ts_world_frame
+        )
+
+        shapes, shape_part = [], []
+        for index, part in enumerate(parts):
+            for shape in part.shapes:
+                shapes.append(shape)
+                shape_part.append(index)
+
+        Ts_link_shape = Ts_link_part[np.array(shape_part, dtype=int)] @ stack(
+            [shape.T_part_shape for shape in shapes]
+        )
+
+        self.T_world_link = T_world_link
+        self.T_parent_link = dict(zip(links, Ts_parent_link))
+        self.T_link_part = dict(zip(parts, Ts_link_part))
+        self.T_link_shape = dict(zip(shapes, Ts_link_shape))
+        self.T_link_frame = dict(zip(frames, Ts_link_frame))
+
     def add_actuators(self, robot: Robot):
         self.append("<actuator>")
 
@@ -161,99 +306,106 @@ class ExporterMuJoCo(Exporter):
         self.append("</equality>")
 
     def add_inertial(self, mass: float, com: np.ndarray, inertia: np.ndarray):
+        # Converting to plain floats once, rather than formatting numpy scalars
+        x, y, z = com.tolist()
+        (ixx, ixy, ixz), (_, iyy, iyz), (_, _, izz) = inertia.tolist()
+
         # Ensuring epsilon masses and inertias
-        mass = max(1e-9, mass)
-        inertia[0, 0] = max(1e-9, inertia[0, 0])
-        inertia[1, 1] = max(1e-9, inertia[1, 1])
-        inertia[2, 2] = max(1e-9, inertia[2, 2])
+        mass = max(1e-9, float(mass))
+        ixx = max(1e-9, ixx)
+        iyy = max(1e-9, iyy)
+        izz = max(1e-9, izz)
 
         # Populating body inertial properties
         # https://mujoco.readthedocs.io/en/stable/XMLreference.html#body-inertial
-        inertial: str = "<inertial "
-        inertial += 'pos="%g %g %g" ' % tuple(com)
-        inertial += 'mass="%g" ' % mass
-        inertial += 'fullinertia="%g %g %g %g %g %g" ' % (
-            inertia[0, 0],
-            inertia[1, 1],
-            inertia[2, 2],
-            inertia[0, 1],
-            inertia[0, 2],
-            inertia[1, 2],
-        )
-        inertial += " />"
-        self.append(inertial)
+        self.append(INERTIAL_FORMAT % (x, y, z, mass, ixx, iyy, izz, ixy, ixz, iyz))
 
-    def add_mesh(self, part: Part, class_: str, T_world_link: np.ndarray, mesh: Mesh):
+    def escape(self, unescaped: str) -> str:
         """
-        Add a mesh node (e.g. STL) to the MuJoCo file
+        Escapes a string for XML, caching the result since the same mesh and
+        material names are used many times
         """
-        # Retrieving mesh file and material name
-        mesh_file = os.path.relpath(mesh.filename, self.config.asset_path(""))
-        mesh_file_no_ext = ".".join(os.path.basename(mesh_file).split(".")[:-1])
-        material_name = mesh_file_no_ext + "_material"
+        if unescaped not in self.escaped:
+            self.escaped[unescaped] = xml_escape(unescaped)
+        return self.escaped[unescaped]
 
-        # Relative frame
-        T_link_part = np.linalg.inv(T_world_link) @ part.T_world_part
+    def get_mesh_names(self, filename: str) -> tuple[str, str, str]:
+        """
+        Retrieves the mesh file (relative to the assets directory), mesh name
+        and material name for a given mesh filename
+        """
+        if filename not in self.mesh_names:
+            mesh_file = os.path.relpath(filename, self.config.asset_path(""))
+            mesh_name = os.path.splitext(os.path.basename(mesh_file))[0]
+            material_name = mesh_name + "_material"
+            self.mesh_names[filename] = (mesh_file, mesh_name, material_name)
 
-        # Adding the geom node
-        geom = f'<geom type="mesh" class="{class_}" '
-        geom += self.pos_quat(T_link_part) + " "
-        geom += f'mesh="{xml_escape(mesh_file_no_ext)}" '
-        geom += f'material="{xml_escape(material_name)}" '
-        geom += " />"
+        return self.mesh_names[filename]
+
+    def add_mesh(self, part: Part, class_: str, T_link_part: np.ndarray, mesh: Mesh):
+        """
+        Add a mesh node (e.g. STL) to the MuJoCo file
+        """
+        mesh_file, mesh_name, material_name = self.get_mesh_names(mesh.filename)
 
         # Adding the mesh and material to appear in the assets section
-        self.meshes.append(mesh_file)
+        self.meshes[mesh_file] = None
         self.materials[material_name] = mesh.color
 
-        self.append(geom)
+        # Adding the geom node
+        self.append(
+            MESH_FORMAT
+            % (
+                class_,
+                *self.pos_quat_values(T_link_part),
+                self.escape(mesh_name),
+                self.escape(material_name),
+            )
+        )
 
-    def add_shape(
-        self, part: Part, class_: str, T_world_link: np.ndarray, shape: Shape
-    ):
+    def add_visual_shape(self, part: Part, T_link_shape: np.ndarray, shape: Shape):
         """
-        Add pure shape geometry.
+        Add pure shape visual geometry.
         """
-        geom = f'<geom class="{class_}" '
+        material_name = f"{part.name}_material"
+        self.materials[material_name] = shape.color
 
-        T_link_shape = (
-            np.linalg.inv(T_world_link) @ part.T_world_part @ shape.T_part_shape
-        )
-        geom += self.pos_quat(T_link_shape) + " "
-
-        if isinstance(shape, Box):
-            geom += 'type="box" size="%g %g %g" ' % tuple(shape.size / 2)
-        elif isinstance(shape, Cylinder):
-            geom += 'type="cylinder" size="%g %g" ' % (
-                shape.radius,
-                shape.length / 2,
+        self.append(
+            SHAPE_FORMATS[type(shape), True]
+            % (
+                *self.pos_quat_values(T_link_shape),
+                *SHAPE_SIZES[type(shape)](shape),
+                self.escape(material_name),
             )
-        elif isinstance(shape, Sphere):
-            geom += 'type="sphere" size="%g" ' % shape.radius
-
-        if class_ == "visual":
-            material_name = f"{part.name}_material"
-            self.materials[material_name] = shape.color
-            geom += f'material="{xml_escape(material_name)}" '
+        )
 
-        geom += " />"
-        self.append(geom)
+    def add_collision_shape(self, T_link_shape: np.ndarray, shape: Shape):
+        """
+        Add pure shape collision geometry.
+        """
+        self.append(
+            SHAPE_FORMATS[type(shape), False]
+            % (*self.pos_quat_values(T_link_shape), *SHAPE_SIZES[type(shape)](shape))
+        )
 
-    def add_geometries(self, part: Part, T_world_link: np.ndarray):
+    def add_geometries(self, part: Part):
         """
         Add a part geometries
         """
+        T_link_part = self.T_link_part[part]
+
         for shape in part.shapes:
+            T_link_shape = self.T_link_shape[shape]
             if shape.visual:
-                self.add_shape(part, "visual", T_world_link, shape)
+                self.add_visual_shape(part, T_link_shape, shape)
             if shape.collision:
-                self.add_shape(part, "collision", T_world_link, shape)
+                self.add_collision_shape(T_link_shape, shape)
 
         for mesh in part.meshes:
             if mesh.visual:
-                self.add_mesh(part, "visual", T_world_link, mesh)
+                self.add_mesh(part, "visual", T_link_part, mesh)
             if mesh.collision:
-                self.add_mesh(part, "collision", T_world_link, mesh)
+                self.add_mesh(part, "collision", T_link_part, mesh)
 
     def add_joint(self, joint: Joint):
         self.append(f"<!-- Joint from {joint.parent.name} to {joint.child.name} -->")
@@ -277,15 +429,9 @@ class ExporterMuJoCo(Exporter):
         if joint_limits is not None and joint.properties.get("range", True):
             joint_xml += f'range="{joint_limits[0]} {joint_limits[1]}" '
 
-        for key in (
-            "class",
-            "frictionloss",
-            "armature",
-            "damping",
-            "stiffness",
-        ):
-            if key in joint.properties:
-                joint_xml += f'{key}="{joint.properties[key]}" '
+        for key, value in joint.properties.items():
+            if key in JOINT_ATTRIBUTES:
+                joint_xml += f'{key}="{value}" '
 
         joint_xml += " />"
         self.append(joint_xml)
@@ -293,38 +439,48 @@ class ExporterMuJoCo(Exporter):
     def add_frame(
         self,
         frame: str,
-        T_world_link: np.ndarray,
-        T_world_frame: np.ndarray,
+        T_link_frame: np.ndarray,
         group: int = 0,
     ):
         self.append(f"<!-- Frame {frame} -->")
-        T_link_frame = np.linalg.inv(T_world_link) @ T_world_frame
 
         site: str = f'<site group="{group}" name="{frame}" '
         site += self.pos_quat(T_link_frame) + " "
         site += " />"
         self.append(site)
 
-    def add_link(
-        self,
-        robot: Robot,
-        link: Link,
-        parent_joint: Joint | None = None,
-        T_world_parent: np.ndarray = np.eye(4),
-    ):
+    def add_link(self, link: Link):
         """
-        Adds a link recursively to the URDF file
+        Adds a link and all its descendants to the MuJoCo file, walking the
+        tree with an explicit stack rather than recursively
         """
-        if parent_joint is None:
-            T_world_link = np.eye(4)
-        else:
-            T_world_link = parent_joint.T_world_joint
+        # Stack of (link, parent joint), a None link closes the current body
+        stack: list[tuple[Link | None, Joint | None]] = [(link, None)]
+
+        while stack:
+            link, parent_joint = stack.pop()
+            if link is None:
+                self.append("</body>")
+                continue
+
+            self.add_body(link, parent_joint)
+
+            # Children links are added before closing the body
+            stack.append((None, None))
+            for joint in reversed(self.link_joints.get(link, [])):
+                stack.append((joint.child, joint))
+
+    def add_body(self, link: Link, parent_joint: Joint | None = None):
+        """
+        Opens the body of a link and adds its content
+        """
+        T_world_link = self.T_world_link[link]
+        T_parent_link = self.T_parent_link[link]
 
         childclass = ""
         if parent_joint is None:
             childclass = f'childclass="{self.default_class}" '
         self.append(f"<!-- Link {link.name} -->")
-        T_parent_link = np.linalg.inv(T_world_parent) @ T_world_link
         self.append(
             f'<body name="{link.name}" {self.pos_quat(T_parent_link)} {childclass}>'
         )
@@ -342,40 +498,42 @@ class ExporterMuJoCo(Exporter):
         # Adding geometry objects
         for part in link.parts:
             self.append(f"<!-- Part {part.name} -->")
-            self.add_geometries(part, T_world_link)
+            self.add_geometries(part)
 
         # Adding frames attached to current link
-        for frame, T_world_frame in link.frames.items():
-            self.add_frame(frame, T_world_link, T_world_frame, group=3)
+        for frame in link.frames:
+            self.add_frame(frame, self.T_link_frame[link, frame], group=3)
 
-        # Adding joints and children links
-        for joint in robot.get_link_joints(link):
-            self.add_link(robot, joint.child, joint, T_world_link)
+    def pos_quat_values(self, matrix: np.ndarray) -> tuple[float, ...]:
+        """
+        Turn a transformation matrix into (x, y, z, qw, qx, qy, qz) values
+        """
+        # Parts and bodies are often located at their parent origin
+        if matrix.tolist() == IDENTITY:
+            return IDENTITY_POS_QUAT
 
-        self.append("</body>")
+        x, y, z = matrix[:3, 3].tolist()
+        return (x, y, z, *rotation_matrix_to_quaternion(matrix[:3, :3]))
 
     def pos_quat(self, matrix: np.ndarray) -> str:
         """
         Turn a transformation matrix into 'pos="..." quat="..."' attributes
         """
-        pos = matrix[:3, 3]
-        quat = mat2quat(matrix[:3, :3])
-        xml = 'pos="%g %g %g" quat="%g %g %g %g"' % (*pos, *quat)
-
-        return xml
+        return POS_QUAT_FORMAT % self.pos_quat_values(matrix)
 
     def write_xml(self, robot: Robot, filename: str) -> str:
         super().write_xml(robot, filename)
 
         dirname = os.path.dirname(filename)
-        scene_filename = dirname + "/scene.xml"
-        if not os.path.exists(scene_filename):    
-            scene_xml: str = (
-                os.path.dirname(os.path.realpath(__file__)) + "/assets/scene.xml"
+        scene_filename = os.path.join(dirname, "scene.xml")
+        if not os.path.exists(scene_filename):
+            scene_template = os.path.join(
+                os.path.dirname(os.path.realpath(__file__)), "assets", "scene.xml"
             )
-            scene_xml = open(scene_xml, "r").read()
+            with open(scene_template, "r") as file:
+                scene_xml = file.read()
             scene_xml = scene_xml.format(robot_filename=os.path.basename(filename))
-            with open(scene_filename, "w") as file:
+            with open(scene_filename, "w", buffering=1 << 20) as file:
                 file.write(scene_xml)
                 print(success(f"* Writing scene.xml"))
         else:
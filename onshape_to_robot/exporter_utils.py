@@ -28,3 +28,45 @@ def rotation_matrix_to_rpy(R):
         z = 0
 
     return np.array([x, y, z])
+
+
+def rotation_matrix_to_quaternion(R) -> tuple[float, float, float, float]:
+    """
+    Converts a rotation matrix to a (w, x, y, z) quaternion with w >= 0,
+    using Shepperd's method
+    """
+    (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = R.tolist()
+    trace = m00 + m11 + m22
+
+    if trace > 0:
+        s = 2 * math.sqrt(1 + trace)
+        w, x, y, z = 0.25 * s, (m21 - m12) / s, (m02 - m20) / s, (m10 - m01) / s
+    elif m00 > m11 and m00 > m22:
+        s = 2 * math.sqrt(1 + m00 - m11 - m22)
+        w, x, y, z = (m21 - m12) / s, 0.25 * s, (m01 + m10) / s, (m02 + m20) / s
+    elif m11 > m22:
+        s = 2 * math.sqrt(1 + m11 - m00 - m22)
+        w, x, y, z = (m02 - m20) / s, (m01 + m10) / s, 0.25 * s, (m12 + m21) / s
+    else:
+        s = 2 * math.sqrt(1 + m22 - m00 - m11)
+        w, x, y, z = (m10 - m01) / s, (m02 + m20) / s, (m12 + m21) / s, 0.25 * s
+
+    if w < 0:
+        return -w, -x, -y, -z
+
+    return w, x, y, z
+
+
+def inverse_transform(T: np.ndarray) -> np.ndarray:
+    """
+    Inverts a 4x4 homogeneous rigid transformation, using the fact that its
+    rotation block is orthonormal. A stack of transformations (..., 4, 4) can
+    also be passed, in which case they are all inverted at once
+    """
+    R_inv = np.swapaxes(T[..., :3, :3], -1, -2)
+    T_inv = np.empty(T.shape)
+    T_inv[..., :3, :3] = R_inv
+    T_inv[..., :3, 3] = -(R_inv @ T[..., :3, 3:])[..., 0]
+    T_inv[..., 3, :] = (0.0, 0.0, 0.0, 1.0)
+
+    return T_inv